@@ -23,13 +23,14 @@ def upload_test_file():
     # File details
     file_name = "test_file.txt"
     file_content = "This is a test file."
+    payload = file_content.encode('utf-8')
     
     # Upload the file
     client.put_object(
         bucket_name,
         file_name,
-        data=io.BytesIO(file_content.encode('utf-8')),
-        length=len(file_content)
+        data=io.BytesIO(payload),
+        length=len(payload)
     )
     print(f"Uploaded {file_name} to bucket {bucket_name}")
 
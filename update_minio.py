@@ -1,11 +1,24 @@
-import requests
-import json
-import concurrent.futures
-import io
+import aiohttp
+import asyncio
+import contextlib
+import orjson
 import os
+import queue
+import tempfile
+import threading
 from tqdm import tqdm
 import datetime
+from operator import itemgetter
+from typing import Iterator
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+import certifi
+import urllib3
 from minio import Minio
 import logging
 
@@ -20,121 +33,263 @@ MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_ACCESS_KEY")
 MINIO_SESSION_TOKEN = os.getenv("MINIO_SESSION_TOKEN")
 MINIO_BUCKET = "alimane"
 
-# Initialize Minio client with credentials
+# Initialize Minio client with credentials, on a bounded pool that blocks instead of opening extra connections
 client = Minio(
     MINIO_SERVER,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
     session_token=MINIO_SESSION_TOKEN,
-    secure=True
+    secure=True,
+    http_client=urllib3.PoolManager(
+        num_pools=16,
+        maxsize=64,
+        block=True,
+        timeout=urllib3.Timeout(connect=300, read=300),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
+)
+
+# Arrow view of the same bucket, for column-projected Parquet reads
+fs = pafs.S3FileSystem(
+    endpoint_override=MINIO_SERVER,
+    scheme="https",
+    access_key=MINIO_ACCESS_KEY,
+    secret_key=MINIO_SECRET_KEY,
+    session_token=MINIO_SESSION_TOKEN
 )
 
 # Folder and file configurations
 data_folder = 'diffusion/'
 archive_folder = 'diffusion/TMDB_archive'
-output_folder = 'diffusion/temp_data'
+dataset_object_name = f"{data_folder}TMDB_movies.parquet"
+dataset_partitions_folder = f"{data_folder}TMDB_movies"
 date_today_str = datetime.datetime.utcnow().date().isoformat()
-json_save_object_name = f"{archive_folder}/{date_today_str}_TMDB_movies.ndjson"
+partition_object_name = f"{dataset_partitions_folder}/date={date_today_str}/part.parquet"
+parquet_save_object_name = f"{archive_folder}/combined_{date_today_str}.parquet"
+batch_size = 1024
+row_group_size = 65536
+part_size = 128*1024*1024
+max_concurrency = 64
+max_retries = 8
+backoff_factor = 0.5
+retry_statuses = {429, 500, 502, 503, 504}
+_name = itemgetter('name')
+
+# TMDB endpoints, formatted once so the per-movie path only substitutes the ID
+latest_url = f"https://api.themoviedb.org/3/movie/latest?api_key={TMDB_KEY}"
+movie_url_template = f"https://api.themoviedb.org/3/movie/%d?api_key={TMDB_KEY}&language=en-US&append_to_response=keywords"
+
+# Schema of a TMDB movie details response, with keywords flattened to a string
+_company = pa.struct([("id", pa.int64()), ("logo_path", pa.string()), ("name", pa.string()), ("origin_country", pa.string())])
+_country = pa.struct([("iso_3166_1", pa.string()), ("name", pa.string())])
+_language = pa.struct([("english_name", pa.string()), ("iso_639_1", pa.string()), ("name", pa.string())])
+_collection = pa.struct([("id", pa.int64()), ("name", pa.string()), ("poster_path", pa.string()), ("backdrop_path", pa.string())])
+movie_schema = pa.schema([
+    ("adult", pa.bool_()),
+    ("backdrop_path", pa.string()),
+    ("belongs_to_collection", _collection),
+    ("budget", pa.int64()),
+    ("genres", pa.list_(pa.struct([("id", pa.int64()), ("name", pa.string())]))),
+    ("homepage", pa.string()),
+    ("id", pa.int64()),
+    ("imdb_id", pa.string()),
+    ("origin_country", pa.list_(pa.string())),
+    ("original_language", pa.string()),
+    ("original_title", pa.string()),
+    ("overview", pa.string()),
+    ("popularity", pa.float64()),
+    ("poster_path", pa.string()),
+    ("production_companies", pa.list_(_company)),
+    ("production_countries", pa.list_(_country)),
+    ("release_date", pa.string()),
+    ("revenue", pa.int64()),
+    ("runtime", pa.int64()),
+    ("spoken_languages", pa.list_(_language)),
+    ("status", pa.string()),
+    ("tagline", pa.string()),
+    ("title", pa.string()),
+    ("video", pa.bool_()),
+    ("vote_average", pa.float64()),
+    ("vote_count", pa.int64()),
+    ("keywords", pa.string()),
+])
 
-def get_latest() -> int:
+def tmdb_session() -> aiohttp.ClientSession:
+    """ Create the single TMDB session whose keep-alive connections are shared by every request of a run """
+    connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, headers={"accept": "application/json"})
+
+async def get_json(session: aiohttp.ClientSession, url: str) -> dict:
+    """ GET a TMDB URL, retrying transient failures with exponential backoff or as long as TMDB's Retry-After asks """
+    for attempt in range(max_retries + 1):
+        delay = backoff_factor * 2 ** attempt
+        try:
+            async with session.get(url) as response:
+                if response.status not in retry_statuses or attempt == max_retries:
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+        except aiohttp.ClientConnectionError:
+            if attempt == max_retries:
+                raise
+        await asyncio.sleep(delay)
+
+async def get_latest(session: aiohttp.ClientSession) -> int:
     """ Fetch the latest movie ID from TMDB API """
-    url = f"https://api.themoviedb.org/3/movie/latest?api_key={TMDB_KEY}"
-    response = requests.get(url)
-    response.raise_for_status()
-    latest_id = response.json()['id']
+    latest_id = (await get_json(session, latest_url))['id']
     logging.info(f"Latest movie ID fetched: {latest_id}")
     return latest_id
 
-def get_oldest(dataset_df) -> int:
-    """ Retrieve the oldest movie ID from the dataset """
-    oldest_id = dataset_df['id'].min()
+def get_known_ids() -> np.ndarray:
+    """ Collect the sorted IDs of the base dataset and of the daily partitions appended before today """
+    tables = [pq.read_table(f"{MINIO_BUCKET}/{dataset_object_name}", columns=['id'], filesystem=fs)]
+    partitions_path = f"{MINIO_BUCKET}/{dataset_partitions_folder}"
+    if fs.get_file_info(partitions_path).type != pafs.FileType.NotFound:
+        partitioning = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+        partitions = ds.dataset(partitions_path, format='parquet', partitioning=partitioning, filesystem=fs)
+        # Today's partition is rewritten by this run, so its IDs must not count as known
+        tables.append(partitions.to_table(columns=['id'], filter=ds.field('date') != date_today_str))
+    return np.sort(np.concatenate([pc.drop_null(table['id'].cast(pa.int64())).to_numpy() for table in tables]))
+
+def get_oldest(known_ids: np.ndarray) -> int:
+    """ Retrieve the oldest movie ID from the sorted dataset IDs """
+    oldest_id = int(known_ids[0])
     logging.info(f"Oldest movie ID: {oldest_id}")
     return oldest_id
 
-def get_keywords(movie_id: int) -> dict:
-    """ Fetch keywords for a movie from TMDB """
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/keywords?api_key={TMDB_KEY}"
-    response = requests.get(url)
-    response.raise_for_status()
-    keywords_data = response.json()
-    logging.info(f"Keywords fetched for movie ID {movie_id}")
-    return keywords_data
-
-def process_movie_ids(movie_id: int, client: Minio, pbar: tqdm) -> None:
-    """ Process each movie ID by fetching data and storing it in MinIO """
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={TMDB_KEY}&language=en-US"
-    response = requests.get(url)
-    response.raise_for_status()
-    movie_data = response.json()
-    movie_data['keywords'] = ", ".join([k['name'] for k in get_keywords(movie_id)['keywords']])
-    object_name = f"{output_folder}scrapeTMDB_movies_{movie_id}.ndjson"
-    client.put_object(
-        MINIO_BUCKET, object_name, data=io.BytesIO(json.dumps(movie_data).encode('utf-8')), length=len(json.dumps(movie_data))
-    )
-    logging.info(f"Processed and uploaded data for movie ID {movie_id}")
-    pbar.update(1)
+async def get_details(session: aiohttp.ClientSession, movie_id: int) -> dict:
+    """ Fetch details for a movie from TMDB, with its keywords appended to the same response """
+    return await get_json(session, movie_url_template % movie_id)
+
+def to_record_batch(batch: list) -> pa.RecordBatch:
+    """ Convert queued records to Arrow, retrying one record at a time so a record that does not fit the movie schema is dropped alone """
+    try:
+        return pa.RecordBatch.from_pylist(batch, schema=movie_schema)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        valid = []
+        for record in batch:
+            try:
+                pa.RecordBatch.from_pylist([record], schema=movie_schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as e:
+                logging.error(f"Dropping movie ID {record.get('id')}, it does not fit the movie schema: {e}")
+            else:
+                valid.append(record)
+        return pa.RecordBatch.from_pylist(valid, schema=movie_schema)
+
+def write_records(records: queue.Queue, out, errors: list) -> None:
+    """ Drain movie records from the queue into a single Parquet file until a None sentinel arrives, reporting any failure in `errors` """
+    try:
+        with pq.ParquetWriter(out, movie_schema, compression='snappy') as writer:
+            batch = []
+            while True:
+                record = records.get()
+                if record is not None:
+                    batch.append(record)
+                if batch and (record is None or len(batch) >= batch_size):
+                    writer.write_batch(to_record_batch(batch))
+                    batch = []
+                if record is None:
+                    break
+    except Exception as e:
+        logging.error(f"Error writing combined data: {e}", exc_info=True)
+        errors.append(e)
+
+async def fetch(session: aiohttp.ClientSession, movie_id: int, records: queue.Queue) -> None:
+    """ Fetch a movie ID and queue the record for the combined upload """
+    movie_data = await get_details(session, movie_id)
+    movie_data['keywords'] = ", ".join(map(_name, movie_data['keywords']['keywords']))
+    records.put(movie_data)
+    logging.info(f"Processed data for movie ID {movie_id}")
+
+async def fetch_worker(session: aiohttp.ClientSession, pending: Iterator[int], records: queue.Queue, pbar: tqdm) -> None:
+    """ Fetch movie IDs one after the other from the iterator shared by all workers until it is exhausted """
+    for movie_id in pending:
+        # Missing or failing IDs are skipped, as the other movies still need to go through
+        with contextlib.suppress(Exception):
+            await fetch(session, movie_id, records)
+        pbar.update(1)
+
+async def process_movie_ids(session: aiohttp.ClientSession, movie_ids: list, records: queue.Queue, pbar: tqdm) -> None:
+    """ Process all movie IDs over the shared session with `max_concurrency` workers """
+    pending = iter(movie_ids)
+    await asyncio.gather(*(fetch_worker(session, pending, records, pbar) for _ in range(max_concurrency)))
+
+async def scrape(records: queue.Queue) -> None:
+    """ Fetch the newest movies from TMDB and queue them for the combined upload """
+    async with tmdb_session() as session:
+        latest = await get_latest(session)
+        movie_ids_list = list(range(latest-400, latest + 1))
+        with tqdm(total=len(movie_ids_list), mininterval=0.5, miniters=32) as pbar:
+            await process_movie_ids(session, movie_ids_list, records, pbar)
     
-def process_movie_data(movie_data):
+def process_movie_data(batch: pa.RecordBatch) -> pd.DataFrame:
     """
-    Ensure all data is in string format and handle null values.
+    Ensure all data is in string format and handle null values, one column at a time.
     """
-    # Assuming 'genres' might be a list of dictionaries, we extract genre names as a comma-separated string.
-    if 'genres' in movie_data and isinstance(movie_data['genres'], list):
-        movie_data['genres'] = ", ".join([genre['name'] for genre in movie_data['genres'] if 'name' in genre])
-
-    # Convert all fields to string and handle None types
-    for key, value in movie_data.items():
-        if isinstance(value, list):  # If any other field is a list of dicts, handle similarly
-            movie_data[key] = ", ".join([str(v) for v in value])
-        elif value is None:
-            movie_data[key] = None  # Or convert None to a string or a default value as required
-        else:
-            movie_data[key] = str(value)
-
-    return movie_data
-
-def combine_and_upload(client: Minio, output_folder: str, archive_folder: str):
-    """ Combine all individual movie data files into one and upload to MinIO """
-    objects = client.list_objects(MINIO_BUCKET, prefix=output_folder, recursive=True)
-    combined_data = []
-    for obj in objects:
-        response = client.get_object(MINIO_BUCKET, obj.object_name)
-        combined_data.extend([json.loads(line.decode('utf-8')) for line in response.stream(32*1024)])
-    client.put_object(
-        MINIO_BUCKET, f"{archive_folder}/combined_{date_today_str}.ndjson",
-        data=io.BytesIO(json.dumps(combined_data).encode('utf-8')), length=len(json.dumps(combined_data))
-    )
-    logging.info("Combined data uploaded to MinIO")
+    movie_data = batch.to_pandas(integer_object_nulls=True)
 
-def load_and_update_dataset(client: Minio, original_file: str, update_file: str):
-    """ Load the original dataset, update it with new data, and save back to MinIO without using `with` block for buffer."""
-    try:
-        logging.info("Starting to load the original dataset.")
-        response = client.get_object(MINIO_BUCKET, original_file)
-        original_data = pd.read_parquet(io.BytesIO(response.data))
-        logging.info("Original dataset loaded and converted to DataFrame successfully.")
+    # 'genres' is a list of dictionaries, we extract genre names as a comma-separated string.
+    if 'genres' in movie_data:
+        movie_data['genres'] = movie_data['genres'].map(
+            lambda genres: ", ".join([genre['name'] for genre in genres if genre['name'] is not None]) if genres is not None else None
+        )
+
+    # Any other list field is handled similarly
+    list_cols = [field.name for field in batch.schema if pa.types.is_list(field.type) and field.name != 'genres']
+    movie_data[list_cols] = movie_data[list_cols].map(lambda value: ", ".join([str(v) for v in value]) if value is not None else None)
 
+    # Convert all fields to string, keeping nulls as missing values
+    return movie_data.astype('string')
+
+def is_known(ids: np.ndarray, known_ids: np.ndarray) -> np.ndarray:
+    """ Flag which of `ids` are present in the sorted `known_ids` array """
+    if len(known_ids) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)
+    return known_ids[pos] == ids
+
+def load_and_update_dataset(client: Minio, known_ids: np.ndarray, update_file: str):
+    """ Append the movies of the update file missing from the dataset as today's partition, without rewriting the base dataset."""
+    try:
         logging.info("Starting to load the update data.")
+        schema = pq.read_schema(f"{MINIO_BUCKET}/{dataset_object_name}", filesystem=fs)
         response = client.get_object(MINIO_BUCKET, update_file)
-        update_data = pd.read_json(io.BytesIO(response.data))
-        logging.info("Update data loaded and converted to DataFrame successfully.")
+        try:
+            update_parquet = pq.ParquetFile(pa.BufferReader(response.data))
+        finally:
+            # Hand the connection back to the pool as soon as the body is read
+            response.close()
+            response.release_conn()
+        needed_cols = [c for c in schema.names if c in movie_schema.names]
+        logging.info("Update data loaded successfully.")
 
-        logging.info("Applying data transformations.")
-        update_data = update_data.apply(process_movie_data, axis=1)
-        logging.info("Data transformations applied successfully.")
+        logging.info("Applying data transformations, one batch at a time.")
+        frames = []
+        for batch in update_parquet.iter_batches(batch_size=batch_size, columns=needed_cols):
+            # Movies already present in the dataset are dropped before being decoded to Python objects
+            known = is_known(batch.column('id').to_numpy(), known_ids)
+            batch = batch.filter(pa.array(~known))
+            frames.append(process_movie_data(batch))
+        update_data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=needed_cols)
+        logging.info(f"Data transformations applied successfully. {len(update_data)} new movies to add.")
 
-        logging.info("Combining datasets.")
-        updated_df = pd.concat([original_data, update_data]).drop_duplicates(subset='id').reset_index(drop=True)
-        logging.info(f"Datasets combined. Total records after merge: {len(updated_df)}.")
+        update_table = pa.Table.from_pandas(update_data.reindex(columns=schema.names), preserve_index=False).cast(schema)
 
-        logging.info("Writing combined data to BytesIO object for upload.")
-        buffer = io.BytesIO()
-        updated_df.to_parquet(buffer, index=False)
-        buffer.seek(0)  # Rewind the buffer after writing to ensure it's ready for reading
-        logging.info("Combined data written to buffer successfully.")
+        logging.info("Writing new movies to an Arrow buffer for upload, one row group at a time.")
+        sink = pa.BufferOutputStream()
+        writer = pq.ParquetWriter(sink, update_table.schema, compression='zstd', compression_level=3)
+        for batch in update_table.to_batches(max_chunksize=row_group_size):
+            writer.write_batch(batch)
+        writer.close()
+        buffer = sink.getvalue()
+        logging.info("New movies written to buffer successfully.")
 
-        client.put_object(MINIO_BUCKET, original_file, data=buffer.getvalue(), length=buffer.getbuffer().nbytes)
-        logging.info("Dataset updated and saved back to MinIO successfully.")
+        client.put_object(MINIO_BUCKET, partition_object_name, data=pa.BufferReader(buffer), length=buffer.size, part_size=part_size)
+        logging.info(f"Dataset partition {partition_object_name} saved to MinIO successfully.")
     
     except Exception as e:
         logging.error(f"Error updating dataset: {e}", exc_info=True)
@@ -142,16 +297,26 @@ def load_and_update_dataset(client: Minio, original_file: str, update_file: str)
         
 def executor():
     """ Main executor function """
-    dataset_df = pd.read_parquet(f'https://{MINIO_SERVER}/{MINIO_BUCKET}/diffusion/TMDB_movies.parquet')
-    latest = get_latest()
-    oldest = get_oldest(dataset_df)
-    movie_ids_list = list(range(latest-400, latest + 1))
-    with tqdm(total=len(movie_ids_list)) as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(process_movie_ids, mid, client, pbar) for mid in movie_ids_list]
-            concurrent.futures.wait(futures)
-    combine_and_upload(client, output_folder, archive_folder)
-    load_and_update_dataset(client, 'diffusion/TMDB_movies.parquet', f'{archive_folder}/combined_{date_today_str}.ndjson')
+    known_ids = get_known_ids()
+    oldest = get_oldest(known_ids)
+    records = queue.Queue()
+    with tempfile.SpooledTemporaryFile(max_size=64*1024*1024) as tmp:
+        writer_errors = []
+        writer = threading.Thread(target=write_records, args=(records, tmp, writer_errors))
+        writer.start()
+        try:
+            asyncio.run(scrape(records))
+        finally:
+            records.put(None)
+            writer.join()
+        # A failed encode must not overwrite today's archive and partition with partial data
+        if writer_errors:
+            raise writer_errors[0]
+        length = tmp.tell()
+        tmp.seek(0)
+        client.put_object(MINIO_BUCKET, parquet_save_object_name, data=tmp, length=length, part_size=part_size)
+        logging.info("Combined data uploaded to MinIO")
+    load_and_update_dataset(client, known_ids, parquet_save_object_name)
 
 if __name__ == "__main__":
     executor()